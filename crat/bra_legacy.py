@@ -10,6 +10,7 @@ email: ray.leizhu@outlook.com
 This source code is licensed under the license found in the
 LICENSE file in the root directory of this source tree.
 """
+import os
 from typing import Tuple
 
 import torch
@@ -18,6 +19,20 @@ import torch.nn.functional as F
 from einops import rearrange
 from torch import Tensor
 
+# F.scaled_dot_product_attention with an explicit `scale` argument (torch >= 2.1)
+_HAS_SDPA = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
+# torch.compile of the helpers below is opt-in (CRAT_COMPILE=1), it needs a working dynamo/inductor toolchain
+_USE_COMPILE = os.environ.get('CRAT_COMPILE', '0') == '1'
+
+
+def _maybe_compile(fn):
+    if not (_USE_COMPILE and hasattr(torch, 'compile')):
+        return fn
+    try:
+        return torch.compile(fn, dynamic=True)
+    except Exception: # e.g. dynamo unsupported on this platform/python, stay eager
+        return fn
+
 
 class TopkRouting(nn.Module):
     """
@@ -38,8 +53,6 @@ class TopkRouting(nn.Module):
         self.diff_routing = diff_routing
         # TODO: norm layer before/after linear?
         self.emb = nn.Linear(qk_dim, qk_dim) if param_routing else nn.Identity()
-        # routing activation
-        self.routing_act = nn.Softmax(dim=-1)
     
     def forward(self, query:Tensor, key:Tensor)->Tuple[Tensor]:
         """
@@ -51,62 +64,141 @@ class TopkRouting(nn.Module):
         if not self.diff_routing:
             query, key = query.detach(), key.detach()
         query_hat, key_hat = self.emb(query), self.emb(key) # per-window pooling -> (n, p^2, c) 
-        attn_logit = (query_hat*self.scale) @ key_hat.transpose(-2, -1) # (n, p^2, p^2)
-        topk_attn_logit, topk_index = torch.topk(attn_logit, k=self.topk, dim=-1) # (n, p^2, k), (n, p^2, k)
-        r_weight = self.routing_act(topk_attn_logit) # (n, p^2, k)
+        # routing logits are tiny, keep them in fp32 under autocast so the topk selection is stable
+        with torch.autocast(query.device.type, enabled=False):
+            attn_logit = (query_hat.float()*self.scale) @ key_hat.float().transpose(-2, -1) # (n, p^2, p^2)
+            topk_attn_logit, topk_index = torch.topk(attn_logit, k=self.topk, dim=-1) # (n, p^2, k), (n, p^2, k)
+            r_weight = F.softmax(topk_attn_logit, dim=-1).to(query.dtype) # (n, p^2, k)
         
         return r_weight, topk_index
         
 
+def _gather_scale(kv_flat:Tensor, flat_idx:Tensor, r_weight_flat:Tensor)->Tensor:
+    """
+    kv_flat: (n*p^2, c_kv, w^2) tensor
+    flat_idx, r_weight_flat: (n*p^2*topk) tensor
+
+    Return:
+        (n*p^2*topk, c_kv, w^2) tensor, selected regions scaled by their routing weights
+    """
+    return kv_flat.index_select(0, flat_idx) * r_weight_flat.view(-1, 1, 1)
+
+# let inductor fuse the gather load with the broadcast multiply (no intermediate topk_kv)
+_gather_scale = _maybe_compile(_gather_scale)
+
+
+def _region_attn(q_pix:Tensor, k_pix_sel:Tensor, v_pix_sel:Tensor, num_heads:int)->Tensor:
+    """
+    q_pix: (n, p^2, w^2, c_qk) tensor, pre-scaled
+    k_pix_sel: (n, p^2, topk, c_qk, h_kv*w_kv) tensor
+    v_pix_sel: (n, p^2, topk, c_v, h_kv*w_kv) tensor
+
+    Return:
+        (n*p^2, m, w^2, c_v//m) tensor
+    """
+    n, p2, topk, c_qk, w2_kv = k_pix_sel.size()
+    c_v, w2 = v_pix_sel.size(3), q_pix.size(2)
+    q = q_pix.reshape(n, p2, w2, num_heads, c_qk//num_heads).permute(0, 1, 3, 2, 4)
+    q = q.reshape(n*p2, num_heads, w2, c_qk//num_heads) # (n p3) m w3 c
+    k = k_pix_sel.reshape(n, p2, topk, num_heads, c_qk//num_heads, w2_kv)
+    v = v_pix_sel.reshape(n, p2, topk, num_heads, c_v//num_heads, w2_kv)
+    if _HAS_SDPA:
+        # fused kernels need stride 1 on the last dim and take no transposed operands, so k and v go to BMLC
+        k = k.permute(0, 1, 3, 2, 5, 4).reshape(n*p2, num_heads, topk*w2_kv, c_qk//num_heads) # (n p3) m (k w3) c
+        v = v.permute(0, 1, 3, 2, 5, 4).reshape(n*p2, num_heads, topk*w2_kv, c_v//num_heads) # (n p3) m (k w3) c
+        # fused kernel, never materializes the attention matrix
+        return F.scaled_dot_product_attention(q, k, v, scale=1.0)
+    # k and v stay channel-first (BMCL, a view when topk == 1), matmul reads the transposed v directly
+    k = k.permute(0, 1, 3, 4, 2, 5).reshape(n*p2, num_heads, c_qk//num_heads, topk*w2_kv) # (n p3) m c (k w3)
+    v = v.permute(0, 1, 3, 4, 2, 5).reshape(n*p2, num_heads, c_v//num_heads, topk*w2_kv) # (n p3) m c (k w3)
+    return F.softmax(q @ k, dim=-1) @ v.transpose(-1, -2)
+
+# let inductor fold the head-split permutes into the loads of the attention kernels
+_region_attn = _maybe_compile(_region_attn)
+
+
 class KVGather(nn.Module):
     def __init__(self, mul_weight='none'):
         super().__init__()
         assert mul_weight in ['none', 'soft', 'hard']
         self.mul_weight = mul_weight
+        # batch offsets of the flat region index, keyed by (n, p^2, device)
+        self._cache = {}
 
-    def forward(self, r_idx:Tensor, r_weight:Tensor, kv:Tensor):
+    def forward(self, r_idx:Tensor, r_weight:Tensor, kv):
         """
         r_idx: (n, p^2, topk) tensor
         r_weight: (n, p^2, topk) tensor
-        kv: (n, p^2, w^2, c_kq+c_v)
+        kv: (n, p^2, c_kv, w^2) tensor, or a tuple of such tensors (e.g. separate k and v)
 
         Return:
-            (n, p^2, topk, w^2, c_kq+c_v) tensor
+            (n, p^2, topk, c_kv, w^2) tensor, or a tuple of them matching kv
         """
         # select kv according to routing index
-        n, p2, w2, c_kv = kv.size()
-        topk = r_idx.size(-1)
+        n, p2 = r_idx.size()[:2]
         # print(r_idx.size(), r_weight.size())
-        # FIXME: gather consumes much memory (topk times redundancy), write cuda kernel? 
-        topk_kv = torch.gather(kv.view(n, 1, p2, w2, c_kv).expand(-1, p2, -1, -1, -1), # (n, p^2, p^2, w^2, c_kv) without mem cpy
-                                dim=2,
-                                index=r_idx.view(n, p2, topk, 1, 1).expand(-1, -1, -1, w2, c_kv) # (n, p^2, k, w^2, c_kv)
-                               )
-
+        # gather whole (c_kv, w^2) regions with a flat index into (n*p^2, c_kv, w^2) instead of
+        # an element-wise torch.gather over a (n, p^2, k, c_kv, w^2) expanded index
+        key = (n, p2, r_idx.device)
+        batch_offset = self._cache.get(key)
+        if batch_offset is None:
+            batch_offset = torch.arange(n, dtype=torch.int32, device=r_idx.device).view(n, 1, 1) * p2
+            self._cache[key] = batch_offset
+        # int32 flat index, n*p^2 is far below 2^31, halves index traffic in the gather
+        flat_idx = (r_idx.to(torch.int32) + batch_offset).reshape(-1) # (n*p^2*k)
+
+        if isinstance(kv, tuple):
+            return tuple(self._select(flat_idx, r_weight, t) for t in kv)
+        return self._select(flat_idx, r_weight, kv)
+
+    def _select(self, flat_idx:Tensor, r_weight:Tensor, kv:Tensor)->Tensor:
+        n, p2, c_kv, w2 = kv.size()
+        topk = r_weight.size(-1)
         if self.mul_weight == 'soft':
-            topk_kv = r_weight.view(n, p2, topk, 1, 1) * topk_kv # (n, p^2, k, w^2, c_kv)
+            # scale while gathering instead of a second pass over topk_kv
+            topk_kv = _gather_scale(kv.reshape(n*p2, c_kv, w2), flat_idx, r_weight.reshape(-1))
+            topk_kv = topk_kv.view(n, p2, topk, c_kv, w2) # (n, p^2, k, c_kv, w^2)
         elif self.mul_weight == 'hard':
             raise NotImplementedError('differentiable hard routing TBA')
-        # else: #'none'
-        #     topk_kv = topk_kv # do nothing
+        else: #'none'
+            topk_kv = kv.reshape(n*p2, c_kv, w2).index_select(0, flat_idx).view(n, p2, topk, c_kv, w2) # (n, p^2, k, c_kv, w^2)
 
         return topk_kv
 
 class QKVLinear(nn.Module):
-    def __init__(self, dim, qk_dim, bias=True):
+    """
+    fused q/k/v projection, returns q, k, v as views of one [q | k | v] output
+    Args:
+        q_scale: float or None, if set q is returned multiplied by q_scale (i.e. already scaled
+            for attention), so this is no longer a plain projection for q
+    """
+    def __init__(self, dim, qk_dim, bias=True, q_scale=None):
         super().__init__()
         self.dim = dim
         self.qk_dim = qk_dim
         self.qkv = nn.Linear(dim, qk_dim + qk_dim + dim, bias=bias)
+        # q_scale is folded into the q rows of the projection, applied to the (small) weight at
+        # every call rather than baked into the parameter, so checkpoints and training dynamics are unchanged
+        self.q_scale = q_scale
+        if q_scale is not None:
+            row_scale = torch.ones(qk_dim + qk_dim + dim)
+            row_scale[:qk_dim] = q_scale
+            self.register_buffer('row_scale', row_scale, persistent=False)
     
     def forward(self, x):
         # keep = self.qkv(x)
         # q, kv = self.qkv(x).split([self.qk_dim, self.qk_dim+self.dim], dim=-1)
         # print("stop")
-        q, k, v = self.qkv(x).split([self.qk_dim, self.qk_dim, self.dim], dim=-1)
-        kv = torch.cat([k, v], dim=-1)
-        # return q, k, v
-        return q, kv, k, v
+        # projection is laid out as [q | k | v], q, k and v are zero-copy views of it
+        if self.q_scale is None:
+            qkv = self.qkv(x)
+        else:
+            bias = self.qkv.bias * self.row_scale if self.qkv.bias is not None else None
+            qkv = F.linear(x, self.qkv.weight * self.row_scale.unsqueeze(-1), bias)
+        q = qkv.narrow(-1, 0, self.qk_dim)
+        k = qkv.narrow(-1, self.qk_dim, self.qk_dim)
+        v = qkv.narrow(-1, self.qk_dim + self.qk_dim, self.dim)
+        return q, k, v
 
 class BiLevelRoutingAttention(nn.Module):
     """
@@ -117,11 +209,16 @@ class BiLevelRoutingAttention(nn.Module):
     param_routing: extra linear for routing
     diff_routing: wether to set routing differentiable
     soft_routing: wether to multiply soft routing weights 
+    autocast_dtype: None or torch.dtype, e.g. torch.bfloat16 to run the projections and attention matmuls
+        under autocast (routing stays fp32). None leaves precision to the caller
+
+    softmax is called functionally so that torch.compile(module, dynamic=False) can fuse it with
+    the surrounding elementwise ops.
     """
     def __init__(self, topk, dim, num_heads=8, n_win=7, qk_dim=None, qk_scale=None,
                  kv_per_win=4, kv_downsample_ratio=4, kv_downsample_kernel=None, kv_downsample_mode='identity',
                  param_attention="qkvo", param_routing=False, diff_routing=False, soft_routing=False, side_dwconv=3,
-                 auto_pad=False):
+                 auto_pad=False, autocast_dtype=None):
         super().__init__()
         # local attention setting
         self.dim = dim
@@ -137,14 +234,16 @@ class BiLevelRoutingAttention(nn.Module):
         #             lambda x: torch.zeros_like(x) # 删除lepe
         
         ################ global routing setting #################
+        assert topk <= n_win ** 3, 'topk cannot exceed the number of regions n_win**3!'
         self.topk = topk
         self.param_routing = param_routing
         self.diff_routing = diff_routing
         self.soft_routing = soft_routing
         # router
         assert not (self.param_routing and not self.diff_routing) # cannot be with_param=True and diff_routing=False
+        # q is produced pre-scaled by QKVLinear; without the routing embedding the router can use it as is
         self.router = TopkRouting(qk_dim=self.qk_dim,
-                                  qk_scale=self.scale,
+                                  qk_scale=self.scale if self.param_routing else 1.0,
                                   topk=self.topk,
                                   diff_routing=self.diff_routing,
                                   param_routing=self.param_routing)
@@ -159,10 +258,10 @@ class BiLevelRoutingAttention(nn.Module):
         # qkv mapping (shared by both global routing and local attention)
         self.param_attention = param_attention
         if self.param_attention == 'qkvo':
-            self.qkv = QKVLinear(self.dim, self.qk_dim)
+            self.qkv = QKVLinear(self.dim, self.qk_dim, q_scale=self.scale)
             self.wo = nn.Linear(dim, dim)
         elif self.param_attention == 'qkv':
-            self.qkv = QKVLinear(self.dim, self.qk_dim)
+            self.qkv = QKVLinear(self.dim, self.qk_dim, q_scale=self.scale)
             self.wo = nn.Identity()
         else:
             raise ValueError(f'param_attention mode {self.param_attention} is not surpported!')
@@ -197,19 +296,41 @@ class BiLevelRoutingAttention(nn.Module):
             raise NotImplementedError('conv policy is not implemented yet!')
         else:
             raise ValueError(f'kv_down_sample_mode {self.kv_downsaple_mode} is not surpported!')
-
-        # softmax for local attention
-        self.attn_act = nn.Softmax(dim=-1)
+        # AdaptiveAvgPool2d(1) over (n p3) c d h w pools h and w only: pool straight from the
+        # window layout instead, no (n p3) c d h w permute
+        self.kv_down_fast = self.kv_downsample_mode == 'ada_avgpool' and self.kv_per_win == 1
 
         self.auto_pad=auto_pad
+        self.autocast_dtype = autocast_dtype
+
+    def _kv_down(self, kv:Tensor)->Tensor:
+        """
+        kv: (n, p^2, w, w, w, c) tensor of windowed k or v
+
+        Return:
+            (n, p^2, c, h_kv*w_kv) tensor
+        """
+        n, p3, win_d, win_h, win_w, c = kv.size()
+        if self.kv_down_fast:
+            return kv.mean(dim=(3, 4)).permute(0, 1, 3, 2) # n p3 c d
+        kv_pix = self.kv_down(kv.reshape(n*p3, win_d, win_h, win_w, c).permute(0, 4, 1, 2, 3)) # (n p3) c d h w
+        return kv_pix.reshape(n, p3, c, -1) # n p3 c (d h w)
 
     def forward(self, x, ret_attn_mask=False):
         """
         x: NHWC tensor
 
         Return:
-            NHWC tensor
+            NHWC tensor, followed by q, k, v (and r_weight, r_idx, attn_weight before them if ret_attn_mask).
+            NOTE: q is returned pre-scaled, i.e. multiplied by self.scale, as the scale is folded into
+            the q projection
         """
+        if self.autocast_dtype is None:
+            return self._forward(x, ret_attn_mask)
+        with torch.autocast(x.device.type, dtype=self.autocast_dtype):
+            return self._forward(x, ret_attn_mask)
+
+    def _forward(self, x, ret_attn_mask=False):
          # NOTE: use padding for semantic segmentation
         ###################################################
         # if self.auto_pad:
@@ -234,9 +355,9 @@ class BiLevelRoutingAttention(nn.Module):
             pad_r = (self.n_win - W_in % self.n_win) % self.n_win
             pad_b = (self.n_win - H_in % self.n_win) % self.n_win
             x = F.pad(x, (0, 0, # dim=-1
-                          pad_l, pad_d, # dim=-2
-                          pad_l, pad_r, # dim=-3
-                          pad_t, pad_b)) # dim=-4
+                          pad_l, pad_r, # dim=-2
+                          pad_t, pad_b, # dim=-3
+                          pad_l, pad_d)) # dim=-4
             _, D, H, W, _ = x.size() # padded size
         else:
             N, D, H, W, C = x.size()
@@ -249,7 +370,12 @@ class BiLevelRoutingAttention(nn.Module):
 
         # x: (n h w c) -> (1 56 56 96)
         # 3dx: (n d h w c) -> (1, 32, 32, 32, 72) (n_win=8)
-        x = rearrange(x, "n (q d) (j h) (i w) c -> n (q j i) d h w c", j=self.n_win, i=self.n_win, q=self.n_win)
+        # window partition, "n (q d) (j h) (i w) c -> n (q j i) d h w c"
+        n_win = self.n_win
+        p3 = n_win ** 3
+        win_d, win_h, win_w = D//n_win, H//n_win, W//n_win
+        x = x.reshape(N, n_win, win_d, n_win, win_h, n_win, win_w, C).permute(0, 1, 3, 5, 2, 4, 6, 7)
+        x = x.contiguous().view(N, p3, win_d, win_h, win_w, C)
         # 3dx: (n (q j i) d h w c) -> (1, 64, 8, 8, 8, 72)
         # x: (n (j i) h w c) -> (1 49 8 8 96)
 
@@ -257,63 +383,75 @@ class BiLevelRoutingAttention(nn.Module):
 
         #################qkv projection###################
         # q: (n, p^2, w, w, c_qk)
-        # kv: (n, p^2, w, w, c_qk+c_v)
-        # NOTE: separte kv if there were memory leak issue caused by gather
-        q, kv, k, v = self.qkv(x)
-        # q: (1, 49, 8, 8, 96)  kv: (1, 49, 8, 8, 192)
+        # k: (n, p^2, w, w, c_qk), v: (n, p^2, w, w, c_v)
+        # k and v are kept separate all the way through the gather, no concatenated kv
+        q, k, v = self.qkv(x)
+        # q: (1, 49, 8, 8, 96)  k: (1, 49, 8, 8, 96)  v: (1, 49, 8, 8, 96)
 
         # 3d_q: (n, p^3, w, w, w, c_qk) (1, 64, 8, 8, 8, 72)
-        # 3d_kv: (n, p^3, w, w, w, c_qk+c_v)
+        # 3d_k: (n, p^3, w, w, w, c_qk), 3d_v: (n, p^3, w, w, w, c_v)
 
         # pixel-wise qkv
         # q_pix: (n, p^2, w^2, c_qk)
-        # kv_pix: (n, p^2, h_kv*w_kv, c_qk+c_v)
-        q_pix = rearrange(q, 'n p3 d h w c -> n p3 (d h w) c')
-        kv_pix = self.kv_down(rearrange(kv, 'n p3 d h w c -> (n p3) c d h w'))
-        kv_pix = rearrange(kv_pix, '(n q j i) c d h w -> n (q j i) (d h w) c', j=self.n_win, i=self.n_win, q=self.n_win)
-        # q: (1, 49, 64, 96)  kv: (1, 49, 64, 192)
-        # kv (1, 64, 512, 144)
+        # k_pix/v_pix: (n, p^2, c, h_kv*w_kv), channel-first so that selected k needs no transpose
+        q_pix = q.reshape(N, p3, win_d*win_h*win_w, -1) # n p3 (d h w) c
+        k_pix, v_pix = self._kv_down(k), self._kv_down(v)
+        # q_pix: (1, 49, 64, 96)  k_pix/v_pix: (1, 49, 96, 64)
+        # 3d k_pix/v_pix: (1, 64, 72, 512)
         # 2d_q_pix: (n, p ^ 2, w ^ 2, c_qk)
         # 3d_q: (n, p^3, w^3, c_qk)
 
-        # 3d_kv: (n, p^3, w^3, c_qk+c_v)
-
-        # window-wise (region q-kv - mean)
-        q_win, k_win = q.mean([2, 3, 4]), kv[..., 0:self.qk_dim].mean([2, 3, 4]) # window-wise qk, (n, p^2, c_qk), (n, p^2, c_qk)
-        # q_win: (1, 49, 96) k_win: (1, 49, 96)
-        # 3D: (n, p^3, c_qk)
-        # 通过计算pixel-wise和window-wise的qk后，q,kv维度一致
-        # 49 regions, 96 特征长度
-        ##################side_dwconv(lepe)##################
-        # NOTE: call contiguous to avoid gradient warning when using ddp
-        # lepe = self.lepe(rearrange(kv[..., self.qk_dim:], 'n (j i) h w c -> n c (j h) (i w)', j=self.n_win, i=self.n_win).contiguous()) # 去掉lepe
-        # lepe = rearrange(lepe, 'n c (j h) (i w) -> n (j h) (i w) c', j=self.n_win, i=self.n_win) # 去掉lepe
-
-        ############ gather q dependent k/v #################
-        # topk: 1
-        r_weight, r_idx = self.router(q_win, k_win) # both are (n, p^2, topk) tensors
-        # r_idx: (1, 64, 8, 4); r_weight(1, 64, 8, 4) -> 8 不对
-        # r_idx: (n, p ^ 2, topk)
-        # tensor
-        # r_weight: (n, p ^ 2, topk)
-        # tensor
-
-        kv_pix_sel = self.kv_gather(r_idx=r_idx, r_weight=r_weight, kv=kv_pix) #(n, p^2, topk, h_kv*w_kv, c_qk+c_v)
-        k_pix_sel, v_pix_sel = kv_pix_sel.split([self.qk_dim, self.dim], dim=-1)
-        # kv_pix_sel: (n, p^2, topk, h_kv*w_kv, c_qk) -> (1, 49, 1, 64, 192)
-        # k_pix_sel: (n, p^2, topk, h_kv*w_kv, c_v) -> (1, 49, 1, 64, 96)
+        # 3d_k_pix: (n, p^3, c_qk, w^3), 3d_v_pix: (n, p^3, c_v, w^3)
+
+        if self.topk == p3 and self.kv_gather.mul_weight == 'none' and not ret_attn_mask:
+            # every region would select every region and attention is order-free over keys,
+            # so skip routing and gather and attend to all keys directly
+            out = _region_attn(q_pix.reshape(N, 1, -1, q_pix.size(-1)), k_pix.unsqueeze(1), v_pix.unsqueeze(1),
+                               self.num_heads) # (n, m, p^2*w^2, c)
+            out = out.reshape(N, self.num_heads, p3, -1, out.size(-1)).transpose(1, 2) # (n, p^2, m, w^2, c)
+        else:
+            # window-wise (region q-kv - mean)
+            q_win, k_win = q.mean([2, 3, 4]), k.mean([2, 3, 4]) # window-wise qk, (n, p^2, c_qk), (n, p^2, c_qk)
+            if self.param_routing: # undo the folded scale before the routing embedding
+                q_win = q_win / self.scale
+            # q_win: (1, 49, 96) k_win: (1, 49, 96)
+            # 3D: (n, p^3, c_qk)
+            # 通过计算pixel-wise和window-wise的qk后，q,kv维度一致
+            # 49 regions, 96 特征长度
+            ##################side_dwconv(lepe)##################
+            # NOTE: call contiguous to avoid gradient warning when using ddp
+            # lepe = self.lepe(rearrange(kv[..., self.qk_dim:], 'n (j i) h w c -> n c (j h) (i w)', j=self.n_win, i=self.n_win).contiguous()) # 去掉lepe
+            # lepe = rearrange(lepe, 'n c (j h) (i w) -> n (j h) (i w) c', j=self.n_win, i=self.n_win) # 去掉lepe
+
+            ############ gather q dependent k/v #################
+            # topk: 1
+            r_weight, r_idx = self.router(q_win, k_win) # both are (n, p^2, topk) tensors
+            # r_idx: (1, 64, 8, 4); r_weight(1, 64, 8, 4) -> 8 不对
+            # r_idx: (n, p ^ 2, topk)
+            # tensor
+            # r_weight: (n, p ^ 2, topk)
+            # tensor
+
+            k_pix_sel, v_pix_sel = self.kv_gather(r_idx=r_idx, r_weight=r_weight, kv=(k_pix, v_pix)) #(n, p^2, topk, c_qk or c_v, h_kv*w_kv)
+            # k_pix_sel: (n, p^2, topk, c_qk, h_kv*w_kv) -> (1, 49, 1, 96, 64)
+            # v_pix_sel: (n, p^2, topk, c_v, h_kv*w_kv) -> (1, 49, 1, 96, 64)
         
-        ######### do attention as normal ####################
-        k_pix_sel = rearrange(k_pix_sel, 'n p3 k w3 (m c) -> (n p3) m c (k w3)', m=self.num_heads) # flatten to BMLC, (n*p^2, m, topk*h_kv*w_kv, c_kq//m) transpose here?
-        v_pix_sel = rearrange(v_pix_sel, 'n p3 k w3 (m c) -> (n p3) m (k w3) c', m=self.num_heads) # flatten to BMLC, (n*p^2, m, topk*h_kv*w_kv, c_v//m)
-        q_pix = rearrange(q_pix, 'n p3 w3 (m c) -> (n p3) m w3 c', m=self.num_heads) # to BMLC tensor (n*p^2, m, w^2, c_qk//m)
-
-        # param-free multihead attention
-        attn_weight = (q_pix * self.scale) @ k_pix_sel # (n*p^2, m, w^2, c) @ (n*p^2, m, c, topk*h_kv*w_kv) -> (n*p^2, m, w^2, topk*h_kv*w_kv)
-        attn_weight = self.attn_act(attn_weight)
-        out = attn_weight @ v_pix_sel # (n*p^2, m, w^2, topk*h_kv*w_kv) @ (n*p^2, m, topk*h_kv*w_kv, c) -> (n*p^2, m, w^2, c)
-        out = rearrange(out, '(n q j i) m (d h w) c -> n (q d) (j h) (i w) (m c)', j=self.n_win, i=self.n_win, q=self.n_win,
-                        d=D//self.n_win, h=H//self.n_win, w=W//self.n_win)
+            ######### do attention as normal ####################
+            if not ret_attn_mask:
+                out = _region_attn(q_pix, k_pix_sel, v_pix_sel, self.num_heads) # (n*p^2, m, w^2, c)
+            else:
+                # eager path, the attention weights are returned to the caller
+                k_pix_sel = rearrange(k_pix_sel, 'n p3 k (m c) w3 -> (n p3) m c (k w3)', m=self.num_heads) # flatten to BMCL, (n*p^2, m, c_kq//m, topk*h_kv*w_kv), a view when topk == 1
+                v_pix_sel = rearrange(v_pix_sel, 'n p3 k (m c) w3 -> (n p3) m c (k w3)', m=self.num_heads) # flatten to BMCL, (n*p^2, m, c_v//m, topk*h_kv*w_kv), a view when topk == 1
+                q_pix = rearrange(q_pix, 'n p3 w3 (m c) -> (n p3) m w3 c', m=self.num_heads) # to BMLC tensor (n*p^2, m, w^2, c_qk//m)
+
+                # param-free multihead attention
+                attn_weight = q_pix @ k_pix_sel # q_pix is pre-scaled, (n*p^2, m, w^2, c) @ (n*p^2, m, c, topk*h_kv*w_kv) -> (n*p^2, m, w^2, topk*h_kv*w_kv)
+                attn_weight = F.softmax(attn_weight, dim=-1)
+                out = attn_weight @ v_pix_sel.transpose(-1, -2) # (n*p^2, m, w^2, topk*h_kv*w_kv) @ (n*p^2, m, topk*h_kv*w_kv, c) -> (n*p^2, m, w^2, c)
+        # window reverse, "(n q j i) m (d h w) c -> n (q d) (j h) (i w) (m c)"
+        out = out.reshape(N, n_win, n_win, n_win, self.num_heads, win_d, win_h, win_w, -1) # sdpa output may be strided
+        out = out.permute(0, 1, 5, 2, 6, 3, 7, 4, 8).reshape(N, D, H, W, -1)
 
         # out = out + lepe # 去掉lepe
 
@@ -324,8 +462,9 @@ class BiLevelRoutingAttention(nn.Module):
 
         # NOTE: use padding for semantic segmentation
         # crop padded region
-        if self.auto_pad and (pad_r > 0 or pad_b > 0):
-            out = out[:, :H_in, :W_in, :].contiguous()
+        # leave it as a view, a consumer that needs contiguity will copy anyway
+        if self.auto_pad and (pad_d > 0 or pad_r > 0 or pad_b > 0):
+            out = out[:, :D_in, :H_in, :W_in, :]
 
         if ret_attn_mask:
             return out, r_weight, r_idx, attn_weight, q, k, v